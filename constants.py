@@ -17,6 +17,7 @@ MSG_SAMPLE = (
 )
 
 MSG_UNSUPPORTED_ROUTE = "Cu regret, nu am informații pentru această rută."
+MSG_NO_DATA = "_(date indisponibile momentan)_"
 MSG_ABOUT = (
     f"Roata v{VERSION} lucrează pentru binele public. Spune-le și prietenilor tăi despre mine. "
     "Dacă ai întrebări sau sugestii, folosește comanda /feedback. "
@@ -14,15 +14,23 @@ default_board = [
 ]
 
 
-def build_route_menu(routes):
+def build_route_menu(routes, per_row=5):
     """This constructs a list of buttons to be used in the `routes_board`
     virtual keyboard, which is in turn used in the on-screen keyboard
-    for selecting routes.
+    for selecting routes. The buttons are split into rows, rather than
+    being crammed into a single one.
     :param routes: list of strings, corresponding to route names
+    :param per_row: int, optional, the maximum number of buttons in a row
     :returns: list corresponding to a keyboard widget"""
+    rows = []
     row = []
 
     for route in routes:
-        row.append(InlineKeyboardButton(str(route), callback_data=str(route)))
+        if len(row) == per_row:
+            rows.append(row)
+            row = []
+        row.append(InlineKeyboardButton(route, callback_data=route))
 
-    return [row]
+    if row:
+        rows.append(row)
+    return rows
@@ -1,10 +1,16 @@
 import logging
 import logging.config
 import sys
-import json
 import csv
+import io
 import os
+import pickle  # nosec
+import tempfile
+import threading
+import time
 
+import orjson
+from expiringdict import ExpiringDict
 from reyaml import load_from_file
 from telegram.ext import (
     Updater,
@@ -31,6 +37,11 @@ logging.config.fileConfig("logging.conf")
 
 log = logging.getLogger("infobot")
 
+ROUTES_DIR = "res/routes"
+ROUTES_CACHE = "res/routes.cache.pkl"
+# bump this whenever the shape of Route changes, to invalidate existing caches
+ROUTES_CACHE_VERSION = 2
+
 
 class Infobot:
     def __init__(self, mqtt, bot, config):
@@ -55,11 +66,47 @@ class Infobot:
 
         # this dict will contain Transport objects, the key will be the route
         # name, the value is the object itself, reflecting the last known
-        # state of this transport unit
-        # TODO should be an expiring dict, as at some point a trolleybus will
-        # be taken offline (we won't receive a notification about it), yet the
-        # system will think it still belongs to that route.
-        self.transports = {}
+        # state of this transport unit. It is an expiring dict, as at some point
+        # a trolleybus will be taken offline (we won't receive a notification
+        # about it), yet the system would think it still belongs to that route.
+        self.transports = ExpiringDict(
+            max_len=self.config.get("transport_cache_max", 2048),
+            max_age_seconds=self.config.get("transport_ttl_sec", 900),
+        )
+
+        # rendered digests, the key is the route name, the value is a tuple with
+        # the Markdown string produced by form_digest_markdown, the generation
+        # of the predictions it was rendered from and the time when the oldest
+        # ETAs it shows will expire (None if it shows none)
+        self._digest_cache = {}
+
+        # the key is the route name, the value is a counter that goes up every
+        # time new predictions arrive for that route, so we can tell whether a
+        # rendered digest is still current
+        self._pred_generation = {}
+
+        # the Telegram handlers run in a thread pool, while predictions are
+        # written by the MQTT thread, this lock guards the predictions and the
+        # digest cache
+        self._pred_lock = threading.Lock()
+
+        # maps the kind of MQTT message (the second component of the topic) to
+        # the method that handles it
+        self._mqtt_dispatch = {
+            # data concerning ETA predictions
+            "station": self.refresh_predictions,
+            # location data about the whereabouts of a trolleybus. The data is a
+            # dict with the following keys: rtu_id, board, route, lat, lon, speed, dir
+            "transport": self.refresh_transport,
+        }
+
+        # the screenshot shown by /help, filled in by preload_structures, and
+        # the file_id Telegram gives us after the first upload
+        self._help_photo = None
+        self._help_photo_file_id = None
+
+        # the keyboard for picking a route, filled in by preload_structures
+        self._routes_keyboard = None
 
         self.feedback_chat_id = self.config["telegram"]["feedback_chat_id"]
 
@@ -74,7 +121,9 @@ class Infobot:
             transport.board_name = data["board"]
             transport.rtu_id = data["rtu_id"]
 
-            self.transports[data["board"]] = transport
+        # ExpiringDict only resets the age of an entry when it is assigned, so
+        # we store it on every update, not just the first time we see it
+        self.transports[data["board"]] = transport
 
         transport.latitude = data["lat"]
         transport.longitude = data["lon"]
@@ -91,6 +140,40 @@ class Infobot:
             # yet. We ignore it for now, the info will be here within a few iterations
             pass
 
+    def new_route_predictions(self):
+        """Create the container for the ETAs of one route, the keys are station
+        IDs and the values are lists of ETAs. Stations that stop receiving
+        predictions are eventually evicted, so we don't show stale data"""
+        return ExpiringDict(
+            max_len=self.config.get("prediction_cache_max", 1024),
+            max_age_seconds=self.config.get("prediction_ttl_sec", 900),
+        )
+
+    def refresh_predictions(self, data):
+        """Update the ETAs of a given station
+        :param data: dict, the ETA predictions for a station, the keys are:
+                     station_id, name, eta"""
+        eta_map = data["eta"]
+        route = next(iter(eta_map))
+        if route not in self.routes:
+            # we don't know the stations of this route, so we'd never show
+            # these predictions anyway
+            return
+        station_id = data["station_id"]
+
+        # we discard the information about the board numbers, as we won't use it
+        # here, we extract just the ETAs. Sometimes there are dupes, so we collect
+        # them into a set, to filter those dupes
+        predictions = sorted({eta for eta, _board in eta_map[route]})
+
+        # if len(predictions) == 1 and predictions[0] == 0:
+        #     # at the end of the day, we end up with something that looks like a zero
+        #     # prognosis, but actually it is a `void` situation, when no data are available
+        #     predictions = []
+        with self._pred_lock:
+            self.predictions[route][station_id] = predictions
+            self._pred_generation[route] += 1
+
     def load_route(self, path, route_name):
         """Load route data from the given CSV file
         :param path: str, full path to CSV file
@@ -120,21 +203,107 @@ class Infobot:
                 # update the global dictionary of all station IDs and their names
                 self.all_stations[station_id] = station_name
 
-        result = Route(route_name, segments, cutoff_station_id, station_sequence)
+        station_index = {sid: i for i, sid in enumerate(station_sequence)}
+        cutoff_index = station_index.get(cutoff_station_id, -1)
+
+        result = Route(
+            route_name,
+            segments,
+            cutoff_station_id,
+            station_sequence,
+            station_index=station_index,
+            cutoff_index=cutoff_index,
+            header_fwd=f"*{segments[0]}*\n",
+            header_ret=f"\n*{segments[1]}*\n" if len(segments) > 1 else "",
+        )
         return result
 
+    @staticmethod
+    def get_routes_stamp():
+        """Compute a stamp that changes whenever the route files are modified,
+        added or removed
+        :returns: float, the most recent modification time"""
+        entries = [os.path.join(ROUTES_DIR, entry) for entry in os.listdir(ROUTES_DIR)]
+        return max(os.path.getmtime(path) for path in [ROUTES_DIR] + entries)
+
+    def load_routes_cache(self, stamp):
+        """Load the routes and stations from the binary snapshot, if it is
+        up to date
+        :param stamp: float, the current stamp of the route files
+        :returns: bool, True if the data were loaded from the cache"""
+        try:
+            with open(ROUTES_CACHE, "rb") as f:
+                header = pickle.load(f)  # nosec
+                if header != (ROUTES_CACHE_VERSION, stamp):
+                    return False
+                self.routes, self.all_stations = pickle.load(f)  # nosec
+        except Exception as err:
+            # it is only a cache, whatever is wrong with it, we can always fall
+            # back to parsing the CSV files
+            log.debug("Ignoring routes cache `%s`: %r", ROUTES_CACHE, err)
+            return False
+        return True
+
+    def save_routes_cache(self, stamp):
+        """Write the routes and stations to a binary snapshot, so the next
+        start-up doesn't have to parse the CSV files again. The file is replaced
+        atomically, so a crash midway won't leave a broken cache behind
+        :param stamp: float, the current stamp of the route files"""
+        directory = os.path.dirname(ROUTES_CACHE)
+        tmp_path = None
+        try:
+            with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+                tmp_path = f.name
+                pickle.dump((ROUTES_CACHE_VERSION, stamp), f)
+                pickle.dump((self.routes, self.all_stations), f)
+            os.replace(tmp_path, ROUTES_CACHE)
+            tmp_path = None
+        except OSError as err:
+            log.warning("Could not write routes cache: %s", err)
+        finally:
+            # if anything went wrong before the replace, don't leave the
+            # temporary file lying around
+            if tmp_path is not None:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+
     def preload_structures(self):
         """Load information about routes from the available resource files"""
         log.debug("Loading station data")
-        for entry in os.listdir("res/routes"):
-            route_name, _extension = os.path.splitext(entry)
-            route = self.load_route(os.path.join("res/routes", entry), route_name)
-            self.routes[route_name] = route
-            self.predictions[route_name] = {}
+        stamp = self.get_routes_stamp()
+        if self.load_routes_cache(stamp):
+            log.debug("Routes loaded from cache `%s`", ROUTES_CACHE)
+        else:
+            for entry in os.listdir(ROUTES_DIR):
+                route_name, _extension = os.path.splitext(entry)
+                route = self.load_route(os.path.join(ROUTES_DIR, entry), route_name)
+                self.routes[route_name] = route
+            self.save_routes_cache(stamp)
+
+        # route names are a small fixed set that is used as a key everywhere
+        # (predictions, digest cache, keyboard callbacks), so we intern them
+        # to have a single copy of each one
+        self.routes = {sys.intern(name): route for name, route in self.routes.items()}
+        for route_name in self.routes:
+            self.predictions[route_name] = self.new_route_predictions()
+            self._pred_generation[route_name] = 0
         log.info(
             "Loaded %i routes: %s", len(self.routes), sorted(list(self.routes.keys()))
         )
 
+        # the screenshot shown by /help is read once; after it is uploaded the
+        # first time, Telegram gives us a file_id, which we send from then on
+        with open("res/help-screenshot.png", "rb") as f:
+            self._help_photo = f.read()
+
+        # the list of routes doesn't change at run-time, so the keyboard used
+        # for picking one of them is built only once
+        self._routes_keyboard = InlineKeyboardMarkup(
+            k.build_route_menu(sorted(self.routes.keys()))
+        )
+
     def serve(self):
         """The main loop"""
         self.preload_structures()
@@ -155,7 +324,10 @@ class Infobot:
 
         log.info("Starting Telegram bot")
         self.init_bot()
-        self.bot.start_polling()
+        # getUpdates is already a long poll; a longer timeout than the default
+        # 10s means fewer round-trips to Telegram while the bot is idle, the
+        # read latency is raised along with it to leave room for slow replies
+        self.bot.start_polling(poll_interval=0.0, timeout=30, read_latency=5.0)
         self.bot.idle()
 
     @staticmethod
@@ -174,24 +346,69 @@ class Infobot:
             data = self.predictions[route][station_id]
             return str(data)
 
-        # otherwise it is a request for the whole list of stations, we start
-        # with the name of the first segment of the route
-        result = """*%s*\n""" % self.routes[route].segments[0]
+        # otherwise it is a request for the whole list of stations, if nothing
+        # changed since the last time we've rendered it, reuse that result
+        with self._pred_lock:
+            generation = self._pred_generation[route]
+            cached = self._digest_cache.get(route)
+            if cached is not None:
+                result, cached_generation, expires_at = cached
+                if cached_generation == generation and (
+                    expires_at is None or time.time() < expires_at
+                ):
+                    return result
+            # the MQTT thread keeps writing into the predictions, so we render
+            # from a copy taken under the lock. items_with_timestamp() doesn't
+            # skip expired entries, so we filter them out ourselves
+            route_preds = self.predictions[route]
+            ttl = route_preds.max_age
+            now = time.time()
+            live = [
+                (sid, etas, stamp)
+                for sid, (etas, stamp) in route_preds.items_with_timestamp()
+                if now - stamp < ttl
+            ]
+        preds = {sid: etas for sid, etas, _stamp in live}
+        # the digest is only good until the oldest of these ETAs expires
+        expires_at = min(stamp for _sid, _etas, stamp in live) + ttl if live else None
+
+        if not preds:
+            # typically right after start-up, before any ETAs came via MQTT, or
+            # when all of them have expired (e.g. at night); listing every
+            # station with "no data" wouldn't help anyone
+            result = self.routes[route].header_fwd + c.MSG_NO_DATA
+            with self._pred_lock:
+                if self._pred_generation[route] == generation:
+                    self._digest_cache[route] = (result, generation, expires_at)
+            return result
+
+        # the loop below runs for every station, so everything it needs is
+        # looked up once in advance
+        route_obj = self.routes[route]
+        seq = route_obj.station_sequence
+        cutoff_index = route_obj.cutoff_index
+        stations = self.all_stations
+        bus = c.ICON_BUS
+
+        # the pieces are collected in a list and glued together at the end,
+        # rather than growing a string on each iteration. We start with the
+        # name of the first segment of the route
+        parts = [route_obj.header_fwd]
 
         last_prognosis = None
-        for station_id in self.routes[route].station_sequence:
-            if station_id == self.routes[route].cutoff_station_id:
+        for i, station_id in enumerate(seq):
+            if i == cutoff_index:
                 # for easier readability, we add the header for the return part
                 # of the route
-                result += "\n*%s*\n" "" % self.routes[route].segments[1]
+                parts.append(route_obj.header_ret)
 
-            station_name = self.all_stations[station_id]
-            etas = self.predictions[route].get(station_id, [])
+            station_name = stations[station_id]
+            etas = preds.get(station_id, ())
             if not etas:
-                result += f"{station_name}: 🚫\n"
+                parts.append(f"{station_name}: 🚫\n")
                 continue
 
-            string_etas = ", ".join([str(item) for item in etas])
+            string_etas = ", ".join(map(str, etas))
             current_prognosis = etas[0]
             if current_prognosis == 0 and last_prognosis != 0:
                 # it means the trolleybus is there right now, let's add a
@@ -201,7 +418,7 @@ class Infobot:
                 # other, they can both have a legit "0 minutes" ETA, but
                 # only the first entry can realistically be the place where
                 # the transport is right now.
-                result += f"{c.ICON_BUS} {station_name}: {string_etas}\n"
+                parts.append(f"{bus} {station_name}: {string_etas}\n")
             else:
                 if (
                     last_prognosis is not None
@@ -210,10 +427,17 @@ class Infobot:
                 ):
                     # it means we're dealing with the case where the transport is
                     # between stations, so we render a bus icon between stations
-                    result += f"{c.ICON_BUS} \n"
-                result += f"{station_name}: {string_etas}\n"
+                    parts.append(f"{bus} \n")
+                parts.append(f"{station_name}: {string_etas}\n")
             last_prognosis = current_prognosis
 
+        result = "".join(parts)
+        with self._pred_lock:
+            # if new predictions arrived while we were rendering, this result
+            # is already stale, and it mustn't replace a newer one rendered by
+            # another handler in the meantime
+            if self._pred_generation[route] == generation:
+                self._digest_cache[route] = (result, generation, expires_at)
         return result
 
     @staticmethod
@@ -239,6 +463,7 @@ class Infobot:
             reply_markup=ReplyKeyboardMarkup(k.default_board, one_time_keyboard=True),
         )
 
+    @run_async
     def on_bot_prognosis(self, update, context):
         """Send a message when the command /prognosis is issued."""
         user = update.effective_user
@@ -251,9 +476,9 @@ class Infobot:
         if route is None:
             # show 'em the keyboard to ask them to select a route from a list, by
             # pressing a button
-            routes_board = k.build_route_menu(sorted(self.routes.keys()))
-            reply_markup = InlineKeyboardMarkup(routes_board)
-            update.message.reply_text(c.MSG_CHOOSE_ROUTE, reply_markup=reply_markup)
+            update.message.reply_text(
+                c.MSG_CHOOSE_ROUTE, reply_markup=self._routes_keyboard
+            )
         else:
             if route not in self.routes:
                 update.message.reply_text(c.MSG_UNSUPPORTED_ROUTE)
@@ -275,12 +500,16 @@ class Infobot:
             retry_keyboard = InlineKeyboardMarkup(k.build_route_menu([route,]))
             update.message.reply_text(c.MSG_REFRESH, reply_markup=retry_keyboard)
 
-    @staticmethod
-    def on_bot_help(update, context):
+    @run_async
+    def on_bot_help(self, update, context):
         """Send a message when the command /help is issued."""
         update.message.reply_text(c.MSG_HELP)
         update.message.reply_text(c.MSG_SAMPLE)
-        update.message.reply_photo(photo=open("res/help-screenshot.png", "rb"))
+        msg = update.message.reply_photo(
+            photo=self._help_photo_file_id or io.BytesIO(self._help_photo)
+        )
+        if self._help_photo_file_id is None:
+            self._help_photo_file_id = msg.photo[-1].file_id
 
     @staticmethod
     def on_bot_about(update, context):
@@ -374,6 +603,7 @@ class Infobot:
         )
         return handler
 
+    @run_async
     def on_bot_route_button(self, update, context):
         """Invoked when they sent /prognosis without a parameter, then clicked
         a button from the list of routes"""
@@ -404,40 +634,26 @@ class Infobot:
         update.effective_message.reply_text(c.MSG_REFRESH, reply_markup=retry_keyboard)
 
     def on_mqtt(self, client, userdata, msg):
-        log.debug(
-            "MQTT IN %s %i bytes `%s`", msg.topic, len(msg.payload), repr(msg.payload)
-        )
+        # this runs for every message, so we don't want to compute the arguments
+        # unless they are actually going to be logged
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(
+                "MQTT IN %s %i bytes `%r`", msg.topic, len(msg.payload), msg.payload
+            )
         try:
-            data = json.loads(msg.payload)
+            # orjson parses the raw bytes directly, its JSONDecodeError is a
+            # subclass of ValueError
+            data = orjson.loads(msg.payload)
         except ValueError:
-            log.debug("Ignoring bad MQTT data %s", repr(msg.payload))
+            log.debug("Ignoring bad MQTT data %r", msg.payload)
             return
 
-        if "station" in msg.topic:
-            # we're dealing with data concerning ETA predictions
-            route = list(data["eta"].keys())[0]
-            station_id = data["station_id"]
-            if route not in self.predictions:
-                # if this route is not yet in our state dict, add it
-                self.predictions[route] = {}
-
-            # first, we discard the information about the board numbers, as we won't use it
-            # here, we extract just the ETAs
-            predictions = [eta for eta, board in data["eta"][route]]
-
-            # sometimes there are dupes, so we turn them into a set, to filter those dupes
-            predictions = sorted(list(set(predictions)))
-
-            # if len(predictions) == 1 and predictions[0] == 0:
-            #     # at the end of the day, we end up with something that looks like a zero
-            #     # prognosis, but actually it is a `void` situation, when no data are available
-            #     predictions = []
-            self.predictions[route][station_id] = predictions
-
-        elif "transport" in msg.topic:
-            # we're dealing with location data about the whereabouts of a trolleybus. The
-            # data is a dict with the following keys: rtu_id, board, route, lat, lon, speed, dir
-            self.refresh_transport(data)
+        # the topics are `state/station/+` and `state/transport/+`, so the
+        # second component of the path tells us what kind of data this is
+        parts = msg.topic.split("/", 3)
+        handler = self._mqtt_dispatch.get(parts[1]) if len(parts) > 1 else None
+        if handler:
+            handler(data)
 
     @run_async
     def send_message_hook(self, chat_id, text):
@@ -13,7 +13,8 @@ class BotRestApi(object):
         """Initialize the REST API
         :param messageFun: callable, a function that will be invoked when a message was sent via the web-ui"""
         self.messageFun = messageFun
-        self.form = open("res/static/chatform.html", "rb").read()
+        with open("res/static/chatform.html", "rb") as f:
+            self.form = f.read()
         self.url_map = Map(
             [Rule("/", endpoint="root"), Rule("/message", endpoint="message")]
         )
@@ -36,7 +37,9 @@ class BotRestApi(object):
 
     def on_root(self, request):
         """Called when the / page is opened"""
-        return Response(self.form, content_type="text/html")
+        # the page is already in memory as bytes, so there's no need for
+        # Werkzeug to wrap or iterate over it
+        return Response(self.form, content_type="text/html", direct_passthrough=True)
 
     def on_message(self, request):
         """Called when /message is opened"""
@@ -30,20 +30,61 @@ class Route:
     # a given route
     transports: list = None
 
+    # maps {station_id: position} within station_sequence, so we can tell
+    # whether a station is on this route and where, without scanning the list
+    station_index: dict = None
+
+    # the position of cutoff_station_id within station_sequence, -1 if the
+    # route doesn't have a second segment
+    cutoff_index: int = -1
+
+    # Markdown headers for each of the segments, rendered once at load time,
+    # as they're the same in every digest. header_ret is empty if the route
+    # doesn't have a second segment
+    header_fwd: str = ""
+    header_ret: str = ""
+
 
-@dataclass
 class Transport:
-    latitude: float = None
-    longitude: float = None
-    # where it goes, North=0, West=270, South=180, East=90
-    direction: float = None
-    # usually numeric, this is the number written on the trolleybus, e.g. "3913",
-    # but we have to assume the can contain non-digit characters
-    board_name: str = None
-    # human-readable RTU_ID
-    rtu_id: str = None
-    speed: int = 0
-    route: str = None
-    # the order number of the last visited station, this is used to display a header above the map
-    # with the trolleybus position, to make it obvious which way it is moving.
-    last_station_order: int = None
+    # there can be thousands of these, so they don't get a __dict__. This
+    # would be `@dataclass(slots=True)`, but that requires Python 3.10
+    __slots__ = (
+        "latitude",
+        "longitude",
+        "direction",
+        "board_name",
+        "rtu_id",
+        "speed",
+        "route",
+        "last_station_order",
+    )
+
+    def __init__(
+        self,
+        latitude=None,
+        longitude=None,
+        direction=None,
+        board_name=None,
+        rtu_id=None,
+        speed=0,
+        route=None,
+        last_station_order=None,
+    ):
+        self.latitude = latitude
+        self.longitude = longitude
+        # where it goes, North=0, West=270, South=180, East=90
+        self.direction = direction
+        # usually numeric, this is the number written on the trolleybus, e.g. "3913",
+        # but we have to assume the can contain non-digit characters
+        self.board_name = board_name
+        # human-readable RTU_ID
+        self.rtu_id = rtu_id
+        self.speed = speed
+        self.route = route
+        # the order number of the last visited station, this is used to display a header above the map
+        # with the trolleybus position, to make it obvious which way it is moving.
+        self.last_station_order = last_station_order
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"Transport({fields})"